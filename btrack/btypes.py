@@ -111,6 +111,10 @@ class PyTrackObject(ctypes.Structure):
             return "<b>Install pandas for nicer, tabular rendering in Jupyter</b> <br>" + self.__repr__()
 
 
+# numpy equivalent of the PyTrackObject structure (including padding), used to
+# append many objects to the tracker in a single call
+PYTRACKOBJECT_DTYPE = np.dtype(PyTrackObject)
+
 
 
 class PyTrackingInfo(ctypes.Structure):
@@ -195,8 +199,8 @@ class MotionModel:
 
     Notes:
         This is just a wrapper for the data with a few convenience functions
-        thrown in. Matrices must be stored Fortran style, because Eigen uses
-        column major and Numpy uses row major storage.
+        thrown in. Matrices must be stored row major (C order), since they
+        are mapped to row major Eigen matrices by the tracker.
 
     References:
         'A new approach to linear filtering and prediction problems.'
@@ -28,6 +28,7 @@ from . import libwrapper
 
 from .dataio import export_delegator, localizations_to_objects
 from .optimise import optimiser
+from .optimise import hypothesis
 
 import itertools
 
@@ -163,6 +164,9 @@ class BayesianTracker:
         self.max_search_radius = max_search_radius
         self.return_kalman = False
 
+        # scratch space for data returned by the library, reused between tracks
+        self._buffers = {}
+
     def __enter__(self):
         logger.info('Starting BayesianTracker session')
         return self
@@ -171,6 +175,17 @@ class BayesianTracker:
         logger.info('Ending BayesianTracker session')
         self._lib.del_interface(self._engine)
 
+    def _buffer(self, name: str, shape: tuple, dtype):
+        """ Return a scratch buffer of the requested shape and dtype. The
+        buffer is only reallocated if it is too small, so the data must be
+        copied before the buffer is requested again. """
+        buffer = self._buffers.get(name, None)
+        if (buffer is None or buffer.shape[0] < shape[0]
+                or buffer.shape[1:] != shape[1:] or buffer.dtype != dtype):
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer[:shape[0]]
+
     def configure_from_file(self, filename: str):
         """ Configure the tracker from a configuration file """
         config = utils.load_config(filename)
@@ -241,8 +256,8 @@ class BayesianTracker:
             # get the track length
             n = self._lib.track_length(self._engine, i)
 
-            # set up some space for the output and  get the track data
-            refs = np.zeros((n,), dtype='int32')
+            # get the track data using the scratch space
+            refs = self._buffer('refs', (n,), np.int32)
             _ = self._lib.get_refs(self._engine, refs, i)
             tracks.append(refs.tolist())
 
@@ -383,8 +398,20 @@ class BayesianTracker:
             if not isinstance(obj, btypes.PyTrackObject):
                 raise TypeError('track_object must be a PyTrackObject')
 
-            self._frame_range[1] = max(obj.t, self._frame_range[1])
-            _ = self._lib.append(self._engine, obj)
+        # older builds of the library can only append one object at a time
+        if not hasattr(self._lib, 'append_array'):
+            for obj in objects:
+                self._frame_range[1] = max(obj.t, self._frame_range[1])
+                _ = self._lib.append(self._engine, obj)
+
+        # copy the objects into a contiguous buffer and append in a single call
+        elif objects:
+            obj_array = (btypes.PyTrackObject * len(objects))(*objects)
+            obj_array = np.frombuffer(obj_array,
+                                      dtype=btypes.PYTRACKOBJECT_DTYPE)
+            self._frame_range[1] = max(int(obj_array['t'].max()),
+                                       self._frame_range[1])
+            self._lib.append_array(self._engine, obj_array, len(objects))
 
         # store a copy of the list of objects
         self._objects += objects
@@ -464,9 +491,16 @@ class BayesianTracker:
         n_hypotheses = self._lib.create_hypotheses(self._engine,
             self.hypothesis_model, self.frame_range[0], self.frame_range[1])
 
-        # now get all of the hypotheses
-        h = [self._lib.get_hypothesis(self._engine, h) for h in range(n_hypotheses)]
-        return h
+        # older builds of the library can only return one hypothesis at a time
+        if not hasattr(self._lib, 'get_all_hypotheses'):
+            return [self._lib.get_hypothesis(self._engine, i)
+                    for i in range(n_hypotheses)]
+
+        # now get all of the hypotheses in a single call, and return them as a
+        # ctypes array which shares the memory of the numpy buffer
+        h = np.empty((n_hypotheses,), dtype=hypothesis.HYPOTHESIS_DTYPE)
+        self._lib.get_all_hypotheses(self._engine, h, n_hypotheses)
+        return (hypothesis.Hypothesis * n_hypotheses).from_buffer(h)
 
     def optimize(self, **kwargs): return self.optimise(**kwargs)
     def optimise(self,
@@ -496,13 +530,15 @@ class BayesianTracker:
             logger.warning('Optimization failed.')
             return []
 
-        h_original = [h.type for h in hypotheses]
-        h_optimise = [h.type for h in optimised]
-        h_types = sorted(list(set(h_original)), key=lambda h: h.value)
+        # count the hypotheses of each type using the fate values, rather than
+        # creating a Fates enum for every hypothesis
+        h_original = optimiser.hypotheses_to_array(hypotheses)['hypothesis']
+        h_optimise = h_original[selected_hypotheses]
 
-        for h_type in h_types:
-            logger.info((f' - {h_type}: {h_optimise.count(h_type)}'
-                         f' (of {h_original.count(h_type)})'))
+        for h_type in np.unique(h_original):
+            logger.info((f' - {constants.Fates(int(h_type))}: '
+                         f'{np.count_nonzero(h_optimise == h_type)}'
+                         f' (of {np.count_nonzero(h_original == h_type)})'))
         logger.info(f' - TOTAL: {len(hypotheses)} hypotheses')
 
         # now that we have generated the optimal sequence, merge all of the
@@ -521,7 +557,7 @@ class BayesianTracker:
 
         # set up some space for the output
         children = np.zeros((2,), dtype=np.int32)    # pointers to children
-        refs = np.zeros((n,), dtype=np.int32)        # pointers to objects
+        refs = self._buffer('refs', (n,), np.int32)  # pointers to objects
 
         # get the track data
         _ = self._lib.get_refs(self._engine, refs, idx)
@@ -564,9 +600,9 @@ class BayesianTracker:
         sz_cov = self.motion_model.measurements**2 + 1
 
         # otherwise grab the kalman filter data
-        kal_mu = np.zeros((n, sz_mu), dtype=np.float32)     # kalman filtered
-        kal_cov = np.zeros((n, sz_cov), dtype=np.float32)   # kalman covariance
-        kal_pred = np.zeros((n, sz_mu), dtype=np.float32)   # motion predict
+        kal_mu = self._buffer('kal_mu', (n, sz_mu), np.float64)     # filtered
+        kal_cov = self._buffer('kal_cov', (n, sz_cov), np.float64)  # covariance
+        kal_pred = self._buffer('kal_pred', (n, sz_mu), np.float64) # predicted
 
         n_kal = self._lib.get_kalman_mu(self._engine, kal_mu, idx)
         _ = self._lib.get_kalman_covar(self._engine, kal_cov, idx)
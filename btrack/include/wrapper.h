@@ -58,6 +58,9 @@ class InterfaceWrapper
     // append an object to the tracker
     void append(const PyTrackObject a_object);
 
+    // append an array of objects to the tracker
+    void append_array(const PyTrackObject* a_objects, const unsigned int n);
+
     // run the tracking
     const PyTrackInfo* track();
 
@@ -115,6 +118,8 @@ class InterfaceWrapper
                                     const unsigned int a_end_frame );
     // return a specific hypothesis
     PyHypothesis get_hypothesis(const unsigned int a_ID);
+    // return the first n hypotheses in a single call
+    void get_all_hypotheses(PyHypothesis* output, const unsigned int n);
 
     // merge tracks based on optimisation
     void merge(unsigned int* a_hypotheses, unsigned int n_hypotheses);
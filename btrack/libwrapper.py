@@ -20,6 +20,7 @@ __email__ = "a.lowe@ucl.ac.uk"
 import os
 import platform
 import ctypes
+import functools
 import logging
 import numpy as np
 
@@ -27,6 +28,7 @@ from . import utils
 
 from .constants import BTRACK_PATH
 from .btypes import PyTrackObject
+from .btypes import PYTRACKOBJECT_DTYPE
 from .btypes import PyTrackingInfo
 from .optimise import hypothesis
 
@@ -40,31 +42,55 @@ def numpy_pointer_decorator(func):
     """ simple decorator for numpy ctypes pointers """
     return func()
 
+# all arrays passed to the library are row major (C order), arrays which are
+# filled by the library must also be writeable
+C_FLAGS = ('C_CONTIGUOUS', 'ALIGNED')
+C_OUT_FLAGS = C_FLAGS + ('WRITEABLE',)
+
 @numpy_pointer_decorator
 def np_dbl_p():
     """ Temporary function. Will remove in final release """
-    return np.ctypeslib.ndpointer(dtype=np.double, ndim=2, flags='C_CONTIGUOUS')
+    return np.ctypeslib.ndpointer(dtype=np.double, ndim=2, flags=C_FLAGS)
 
 @numpy_pointer_decorator
-def np_dbl_pc():
+def np_dbl_out_p():
     """ Temporary function. Will remove in final release """
-    return np.ctypeslib.ndpointer(dtype=np.double, ndim=2, flags='F_CONTIGUOUS')
+    return np.ctypeslib.ndpointer(dtype=np.double, ndim=2, flags=C_OUT_FLAGS)
 
 @numpy_pointer_decorator
 def np_uint_p():
     """ Temporary function. Will remove in final release """
-    return np.ctypeslib.ndpointer(dtype=np.uint32, ndim=2, flags='C_CONTIGUOUS')
+    return np.ctypeslib.ndpointer(dtype=np.uint32, ndim=2, flags=C_FLAGS)
+
+@numpy_pointer_decorator
+def np_uint_out_p():
+    """ Temporary function. Will remove in final release """
+    return np.ctypeslib.ndpointer(dtype=np.uint32, ndim=2, flags=C_OUT_FLAGS)
 
 @numpy_pointer_decorator
 def np_int_p():
     """ Temporary function. Will remove in final release """
-    return np.ctypeslib.ndpointer(dtype=np.int32, ndim=2, flags='C_CONTIGUOUS')
+    return np.ctypeslib.ndpointer(dtype=np.int32, ndim=2, flags=C_FLAGS)
 
 @numpy_pointer_decorator
 def np_int_vec_p():
     """ Temporary function. Will remove in final release """
-    return np.ctypeslib.ndpointer(dtype=np.int32, ndim=1) #, flags='C_CONTIGUOUS')
+    return np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags=C_OUT_FLAGS)
 
+@numpy_pointer_decorator
+def np_pytrackobject_p():
+    """ Temporary function. Will remove in final release """
+    return np.ctypeslib.ndpointer(dtype=PYTRACKOBJECT_DTYPE, ndim=1,
+                                  flags=C_FLAGS)
+
+@numpy_pointer_decorator
+def np_hypothesis_p():
+    """ Temporary function. Will remove in final release """
+    return np.ctypeslib.ndpointer(dtype=hypothesis.HYPOTHESIS_DTYPE, ndim=1,
+                                  flags=C_OUT_FLAGS)
+
+# shared library extension for each platform, others default to .so
+LIB_EXT = {'Linux': '.so', 'Darwin': '.dylib', 'Windows': '.DLL'}
 
 
 def load_library(filename):
@@ -84,11 +110,10 @@ def load_library(filename):
     lib_file, ext = os.path.splitext(filename)
 
     system = platform.system()
-    version = platform.version()
-    release = platform.release()
+    if system == 'Windows':
+        logger.warning('Windows is not fully supported.')
 
-    file_ext = {'Linux':'.so', 'Darwin':'.dylib', 'Windows':'.DLL'}
-    full_lib_file = lib_file + file_ext[system]
+    full_lib_file = lib_file + LIB_EXT.get(system, '.so')
 
     try:
         lib = ctypes.cdll.LoadLibrary(full_lib_file)
@@ -100,133 +125,144 @@ def load_library(filename):
 
 
 
-def get_library():
-    """ This loads and returns the btrack shared library. """
-    lib = load_library(os.path.join(BTRACK_PATH, 'libs', 'libtracker'))
-
+# function signatures of the shared library: (name, restype, argtypes)
+_SIGNATURES = (
     # deal with constructors/destructors
-    lib.new_interface.restype = ctypes.c_void_p
-    lib.new_interface.argtypes = [ctypes.c_bool]
-
-    lib.del_interface.restype = None
-    lib.del_interface.argtypes = [ctypes.c_void_p]
+    ('new_interface', ctypes.c_void_p, (ctypes.c_bool,)),
+    ('del_interface', None, (ctypes.c_void_p,)),
 
     # check the version number
-    lib.check_library_version.restype = ctypes.c_bool
-    lib.check_library_version.argtypes = [ctypes.c_uint, ctypes.c_uint,
-                                          ctypes.c_uint]
+    ('check_library_version', ctypes.c_bool, (ctypes.c_void_p, ctypes.c_uint,
+                                              ctypes.c_uint, ctypes.c_uint)),
 
     # set the update method
-    lib.set_update_mode.restype = None
-    lib.set_update_mode.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('set_update_mode', None, (ctypes.c_void_p, ctypes.c_uint)),
 
     # set the motion model
-    lib.motion.restype = None
-    lib.motion.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint,
-                            np_dbl_p, np_dbl_p, np_dbl_p, np_dbl_p,
-                            np_dbl_p, ctypes.c_double, ctypes.c_double,
-                            ctypes.c_uint, ctypes.c_double]
+    ('motion', None, (ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint,
+                      np_dbl_p, np_dbl_p, np_dbl_p, np_dbl_p, np_dbl_p,
+                      ctypes.c_double, ctypes.c_double, ctypes.c_uint,
+                      ctypes.c_double)),
 
     # set the object model
-    # lib.model.restype = None
-    # lib.model.argtypes = [ctypes.c_void_p, ctypes.c_uint, np_dbl_p,
-    #                         np_dbl_p, np_dbl_p]
+    # ('model', None, (ctypes.c_void_p, ctypes.c_uint, np_dbl_p, np_dbl_p,
+    #                  np_dbl_p)),
 
-    lib.max_search_radius.restype = None
-    lib.max_search_radius.argtypes = [ctypes.c_void_p, ctypes.c_float]
+    ('max_search_radius', None, (ctypes.c_void_p, ctypes.c_float)),
 
     # append a new observation
-    lib.append.restype = None
-    lib.append.argtypes = [ctypes.c_void_p, PyTrackObject]
+    ('append', None, (ctypes.c_void_p, PyTrackObject)),
+
+    # append an array of new observations
+    ('append_array', None, (ctypes.c_void_p, np_pytrackobject_p,
+                            ctypes.c_uint)),
 
     # run the complete tracking
-    lib.track.restype = ctypes.POINTER(PyTrackingInfo)
-    lib.track.argtypes = [ctypes.c_void_p]
+    ('track', ctypes.POINTER(PyTrackingInfo), (ctypes.c_void_p,)),
 
     # run one or more steps of the tracking, interactive mode
-    lib.step.restype = ctypes.POINTER(PyTrackingInfo)
-    lib.step.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('step', ctypes.POINTER(PyTrackingInfo), (ctypes.c_void_p, ctypes.c_uint)),
 
     # get an individual track length
-    lib.track_length.restype = ctypes.c_uint
-    lib.track_length.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('track_length', ctypes.c_uint, (ctypes.c_void_p, ctypes.c_uint)),
 
     # get a track
-    lib.get.restype = ctypes.c_uint
-    lib.get.argtypes = [ctypes.c_void_p, np_dbl_p, ctypes.c_uint]
+    ('get', ctypes.c_uint, (ctypes.c_void_p, np_dbl_out_p, ctypes.c_uint)),
 
     # get the internal ID of a track
-    lib.get_ID.restype = ctypes.c_uint
-    lib.get_ID.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('get_ID', ctypes.c_uint, (ctypes.c_void_p, ctypes.c_uint)),
 
     # get a track, by reference
-    lib.get_refs.restype = ctypes.c_uint
-    lib.get_refs.argtypes = [ctypes.c_void_p, np_int_vec_p, ctypes.c_uint]
+    ('get_refs', ctypes.c_uint, (ctypes.c_void_p, np_int_vec_p,
+                                 ctypes.c_uint)),
 
     # get the parent ID (i.e. pre-division)
-    lib.get_parent.restype = ctypes.c_uint
-    lib.get_parent.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('get_parent', ctypes.c_uint, (ctypes.c_void_p, ctypes.c_uint)),
 
     # get the root ID (i.e. the root ID of this lineage tree)
-    lib.get_root.restype = ctypes.c_uint
-    lib.get_root.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('get_root', ctypes.c_uint, (ctypes.c_void_p, ctypes.c_uint)),
 
     # get the ID of any children
-    lib.get_children.restype = ctypes.c_uint
-    lib.get_children.argtypes = [ctypes.c_void_p, np_int_vec_p, ctypes.c_uint]
+    ('get_children', ctypes.c_uint, (ctypes.c_void_p, np_int_vec_p,
+                                     ctypes.c_uint)),
 
     # get the fate of the track
-    lib.get_fate.restype = ctypes.c_uint
-    lib.get_fate.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('get_fate', ctypes.c_uint, (ctypes.c_void_p, ctypes.c_uint)),
 
     # get the generational depth of the track
-    lib.get_generation.restype = ctypes.c_uint
-    lib.get_generation.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('get_generation', ctypes.c_uint, (ctypes.c_void_p, ctypes.c_uint)),
 
     # get the kalman filtered position
-    lib.get_kalman_mu.restype = ctypes.c_uint
-    lib.get_kalman_mu.argtypes = [ctypes.c_void_p, np_dbl_p, ctypes.c_uint]
+    ('get_kalman_mu', ctypes.c_uint, (ctypes.c_void_p, np_dbl_out_p,
+                                      ctypes.c_uint)),
 
     # get the kalman covariance
-    lib.get_kalman_covar.restype = ctypes.c_uint
-    lib.get_kalman_covar.argtypes = [ctypes.c_void_p, np_dbl_p, ctypes.c_uint]
+    ('get_kalman_covar', ctypes.c_uint, (ctypes.c_void_p, np_dbl_out_p,
+                                         ctypes.c_uint)),
 
     # get the predicted position at each time step
-    lib.get_kalman_pred.restype = ctypes.c_uint
-    lib.get_kalman_pred.argtypes = [ctypes.c_void_p, np_dbl_p, ctypes.c_uint]
+    ('get_kalman_pred', ctypes.c_uint, (ctypes.c_void_p, np_dbl_out_p,
+                                        ctypes.c_uint)),
 
     # get the label of the object
-    lib.get_label.restype = ctypes.c_uint
-    lib.get_label.argtypes = [ctypes.c_void_p, np_uint_p, ctypes.c_uint]
+    ('get_label', ctypes.c_uint, (ctypes.c_void_p, np_uint_out_p,
+                                  ctypes.c_uint)),
 
     # get the imaging volume
-    lib.get_volume.restype = None
-    lib.get_volume.argtypes = [ctypes.c_void_p, np_dbl_p]
+    ('get_volume', None, (ctypes.c_void_p, np_dbl_out_p)),
 
-    # get the imaging volume
-    lib.set_volume.restype = None
-    lib.set_volume.argtypes = [ctypes.c_void_p, np_dbl_p]
+    # set the imaging volume
+    ('set_volume', None, (ctypes.c_void_p, np_dbl_p)),
 
     # return a dummy object by reference
-    lib.get_dummy.restype = PyTrackObject
-    lib.get_dummy.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    ('get_dummy', PyTrackObject, (ctypes.c_void_p, ctypes.c_int)),
 
     # get the number of tracks
-    lib.size.restype = ctypes.c_uint
-    lib.size.argtypes = [ctypes.c_void_p]
+    ('size', ctypes.c_uint, (ctypes.c_void_p,)),
 
     # calculate the hypotheses
-    lib.create_hypotheses.restype = ctypes.c_uint
-    lib.create_hypotheses.argtypes = [ctypes.c_void_p,
-                                      hypothesis.PyHypothesisParams,
-                                      ctypes.c_uint, ctypes.c_uint]
+    ('create_hypotheses', ctypes.c_uint, (ctypes.c_void_p,
+                                          hypothesis.PyHypothesisParams,
+                                          ctypes.c_uint, ctypes.c_uint)),
 
     # get a hypothesis by ID
-    lib.get_hypothesis.restype = hypothesis.Hypothesis
-    lib.get_hypothesis.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    ('get_hypothesis', hypothesis.Hypothesis, (ctypes.c_void_p,
+                                               ctypes.c_uint)),
+
+    # get all of the hypotheses in a single call
+    ('get_all_hypotheses', None, (ctypes.c_void_p, np_hypothesis_p,
+                                  ctypes.c_uint)),
 
     # merge following optimisation
-    lib.merge.restype = None
-    lib.merge.argtypes = [ctypes.c_void_p, np_uint_p, ctypes.c_uint]
+    ('merge', None, (ctypes.c_void_p, np_uint_p, ctypes.c_uint)),
+)
+
+
+
+# functions which are not in older builds of the shared library (e.g. the
+# prebuilt libraries for other platforms), callers must check for these first
+_OPTIONAL_SIGNATURES = ('append_array', 'get_all_hypotheses')
 
+
+
+def bind_library(lib):
+    """ Set the return and argument types of the shared library functions """
+    for name, restype, argtypes in _SIGNATURES:
+        if name in _OPTIONAL_SIGNATURES and not hasattr(lib, name):
+            logger.info(f'Shared library does not provide {name}.')
+            continue
+        fn = getattr(lib, name)
+        fn.restype = restype
+        fn.argtypes = list(argtypes)
     return lib
+
+
+
+@functools.lru_cache(maxsize=1)
+def get_library():
+    """ This loads and returns the btrack shared library. The library is only
+    loaded and bound on first use, and forked processes inherit it. An out of
+    tree build can be used by setting the BTRACK_LIB environment variable. """
+    default = os.path.join(BTRACK_PATH, 'libs', 'libtracker')
+    lib = load_library(os.environ.get('BTRACK_LIB', default))
+    return bind_library(lib)
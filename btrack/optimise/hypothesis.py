@@ -65,6 +65,10 @@ class Hypothesis(ctypes.Structure):
         return self.probability
 
 
+# numpy equivalent of the Hypothesis structure (including padding), used to
+# transfer all of the hypotheses from the C++ library in a single call
+HYPOTHESIS_DTYPE = np.dtype(Hypothesis)
+
 
 
 class PyHypothesisParams(ctypes.Structure):
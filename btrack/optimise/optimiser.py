@@ -16,7 +16,11 @@
 __author__ = "Alan R. Lowe"
 __email__ = "a.lowe@ucl.ac.uk"
 
+import ctypes
 import logging
+import operator
+import numpy as np
+
 from . import hypothesis
 
 from btrack.constants import Fates, GLPK_OPTIONS
@@ -24,6 +28,10 @@ from btrack.constants import Fates, GLPK_OPTIONS
 from cvxopt.glpk import ilp
 from cvxopt import matrix, spmatrix
 
+from scipy.sparse import bmat, coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
 # get the logger instance
 logger = logging.getLogger('worker_process')
 
@@ -36,6 +44,45 @@ TERM_FATES = (Fates.TERMINATE,
               Fates.TERMINATE_BACK,
               Fates.TERMINATE_LAZY)
 
+# subproblems with fewer hypotheses than this are solved by exhaustive search,
+# above this GLPK (~0.05 ms per subproblem) is faster than the search
+MAX_SEARCH_HYPOTHESES = 16
+
+# get the fields of a Hypothesis as a tuple, in the order of the structure
+HYPOTHESIS_FIELDS = operator.attrgetter(*[f for f, _ in
+                                          hypothesis.Hypothesis._fields_])
+
+# constraints for each type of hypothesis, indexed by the fate value. Each
+# constraint is the half of the A matrix (0: track end, 1: track start) and the
+# field of the hypothesis containing the track ID
+FATE_CONSTRAINTS = {Fates.FALSE_POSITIVE.value: ((0, 'ID'), (1, 'ID')),
+                    Fates.LINK.value: ((0, 'ID'), (1, 'link_ID')),
+                    Fates.DIVIDE.value: ((0, 'ID'),
+                                         (1, 'child_one_ID'),
+                                         (1, 'child_two_ID')),
+                    Fates.APOPTOSIS.value: ((0, 'ID'),),
+                    Fates.MERGE.value: ((1, 'ID'),
+                                        (0, 'parent_one_ID'),
+                                        (0, 'parent_two_ID')),
+                    **{f.value: ((1, 'ID'),) for f in INIT_FATES},
+                    **{f.value: ((0, 'ID'),) for f in TERM_FATES}}
+
+
+def hypotheses_to_array(hypotheses):
+    """ Return the hypotheses as a numpy structured array, with the same layout
+    as the Hypothesis structure. Arrays of hypotheses returned by the tracker
+    share memory with the array, whereas lists of Hypothesis objects are
+    copied. """
+    if isinstance(hypotheses, np.ndarray):
+        return hypotheses
+    if isinstance(hypotheses, ctypes.Array):
+        return np.frombuffer(hypotheses, dtype=hypothesis.HYPOTHESIS_DTYPE)
+
+    return np.fromiter(map(HYPOTHESIS_FIELDS, hypotheses),
+                       dtype=hypothesis.HYPOTHESIS_DTYPE,
+                       count=len(hypotheses))
+
+
 class TrackOptimiser:
     """ TrackOptimiser
 
@@ -54,13 +101,12 @@ class TrackOptimiser:
         3. Merge/'link' trajectories
         4. Assign a 'fate' or optimal hypothesis to each trajectory
 
-    The global optimisation utilises integer optimisation from the GLPK library.
-    Takes in the list of hypotheses and formulates as a mixed integer linear
-    programming problem.  Then attempts to use GLPK to solve the association
-    problem, returns a list of hypotheses to act upon.
+    The global optimisation takes in the list of hypotheses and formulates it
+    as a binary integer linear programming problem, returning a list of
+    hypotheses to act upon.
 
-    We set up a constraints matrix, A in this manner: (num_hypotheses x 2N)
-    Uses cvxopt.gplk.ilp to:
+    We set up a constraints matrix, A in this manner: (2N x num_hypotheses)
+    and solve:
 
     minimize    c'*x
     subject to  G*x <= h
@@ -71,8 +117,18 @@ class TrackOptimiser:
     Since this is a *minimisation* we need to invert the (log) probability of
     each hypothesis.
 
+    Hypotheses are only dependent if they share a track, so A is split into
+    its connected components and each independent subproblem is solved
+    separately, using the fastest method available:
+        1. Exhaustive search, for subproblems with very few hypotheses
+        2. Minimum weight bipartite matching, if no hypothesis involves more
+           than one track end and one track start (i.e. no branches)
+        3. cvxopt.glpk.ilp otherwise
+
     Args:
         hypotheses: a list of PyHypothesis objects from the tracker
+        options: GLPK options, GLPK output is silenced ('msg_lev' is
+            'GLP_MSG_OFF') unless set here
 
     Members:
         optimise()
@@ -82,7 +138,8 @@ class TrackOptimiser:
         PyHypothesis objects.
 
     Notes:
-        If the hypotheses are badly formed, this can take *FOREVER*.
+        If the hypotheses are badly formed, a large subproblem can still take
+        a long time to solve with GLPK.
 
         'Report Automated Cell Lineage Construction' Al-Kofahi et al.
         Cell Cycle 2006 vol. 5 (3) pp. 327-335
@@ -109,7 +166,7 @@ class TrackOptimiser:
 
     def optimise(self):
         """
-        We set up a constraints matrix, A in this manner: (num_hypotheses x 2N).
+        We set up a constraints matrix, A in this manner: (2N x num_hypotheses).
         Rho is the log probability of accepting the hypothesis. x is the
         integer set of hypotheses selected.
 
@@ -121,106 +178,264 @@ class TrackOptimiser:
         if self.options:
             logger.info(f'Using GLPK options: {self.options}...')
 
-        # anon function to renumber track ID from C++
-        trk_idx = lambda h: int(h)-1
+        # get the hypotheses as a structured array (SoA) so that the
+        # constraints can be built with vectorized operations
+        fields = hypotheses_to_array(self.hypotheses)
 
         # calculate the number of hypotheses, could use this moment to cull?
-        n_hypotheses = len(self.hypotheses)
-        N = max(set([int(h.ID) for h in self.hypotheses]))
+        n_hypotheses = fields.shape[0]
+        N = int(fields['ID'].max())
+
+        # renumber track ID from C++, casting each of the ID fields only once
+        trk_idx = {field: fields[field].astype(np.intp) - 1
+                   for field in ('ID', 'link_ID', 'child_one_ID',
+                                 'child_two_ID', 'parent_one_ID',
+                                 'parent_two_ID')}
+
+        types = fields['hypothesis']
+        col_idx = np.arange(n_hypotheses)
+
+        # preallocate the (row, col) entries of the constraints matrix, each
+        # hypothesis contributes at most three entries
+        rows = np.empty((3*n_hypotheses,), dtype=np.intp)
+        cols = np.empty((3*n_hypotheses,), dtype=np.intp)
+        n_entries = 0
+
+        def constrain(mask, *trk_rows):
+            # write all of the entries for these hypotheses as a single block
+            nonlocal n_entries
+            n = np.count_nonzero(mask) * len(trk_rows)
+            block = slice(n_entries, n_entries+n)
+            np.stack(trk_rows, out=rows[block].reshape(len(trk_rows), -1))
+            cols[block].reshape(len(trk_rows), -1)[:] = col_idx[mask]
+            n_entries += n
+
+        # iterate over the types of hypothesis and build the constraints
+        for fate, constraints in FATE_CONSTRAINTS.items():
+            mask = types == fate
+            constrain(mask, *[half*N+trk_idx[field][mask]
+                              for half, field in constraints])
 
         # A is the constraints matrix (store as sparse since mostly empty)
         # note that we make this in the already transposed form...
-        A = spmatrix([], [], [], (2*N, n_hypotheses), 'd')
-        rho = matrix(0., (n_hypotheses, 1), 'd')
-
-        # iterate over the hypotheses and build the constraints
-        # TODO(arl): vectorize this for increased performance
-        for counter, h in enumerate(self.hypotheses):
-
-            # set the hypothesis score
-            rho[counter] = h.log_likelihood
-
-            if h.type == Fates.FALSE_POSITIVE:
-                # is this a false positive?
-                trk = trk_idx(h.ID)
-                A[trk,counter] = 1
-                A[N+trk,counter] = 1
-                continue
-
-            elif h.type in INIT_FATES:
-                # an initialisation, therefore we only present this in the
-                # second half of the A matrix
-                trk = trk_idx(h.ID)
-                A[N+trk,counter] = 1
-                continue
-
-            elif h.type in TERM_FATES:
-                # a termination event, entry in first half only
-                trk = trk_idx(h.ID)
-                A[trk,counter] = 1
-                continue
-
-            elif h.type == Fates.APOPTOSIS:
-                # an apoptosis event, entry in first half only
-                trk = trk_idx(h.ID)
-                A[trk,counter] = 1
-                # A[N+trk,counter] = 1    # NOTE(arl): added 2019/08/29
-                continue
-
-            elif h.type == Fates.LINK:
-                # a linkage event
-                trk_i = trk_idx(h.ID)
-                trk_j = trk_idx(h.link_ID)
-                A[trk_i,counter] = 1
-                A[N+trk_j,counter] = 1
-                continue
-
-            elif h.type == Fates.DIVIDE:
-                # a branch event
-                trk = trk_idx(h.ID)
-                child_one = trk_idx(h.child_one_ID)
-                child_two = trk_idx(h.child_two_ID)
-                A[trk,counter] = 1
-                A[N+child_one,counter] = 1
-                A[N+child_two,counter] = 1
-                continue
-
-            elif h.type == Fates.MERGE:
-                # a merge event
-                trk = trk_idx(h.ID)
-                parent_one = trk_idx(h.parent_one_ID)
-                parent_two = trk_idx(h.parent_two_ID)
-                A[N+trk,counter] = 1
-                A[parent_one,counter] = 1
-                A[parent_two,counter] = 1
-                continue
-
-            else:
-                raise ValueError(f'Unknown hypothesis: {h.type}')
-
-        logger.info('Optimizing...')
+        A = coo_matrix((np.ones((n_entries,)),
+                        (rows[:n_entries], cols[:n_entries])),
+                       shape=(2*N, n_hypotheses)).tocsc()
+
+        # check that every hypothesis has been assigned to the constraints
+        unknown = np.flatnonzero(np.diff(A.indptr) == 0)
+        if unknown.size:
+            h_type = Fates(int(types[unknown[0]]))
+            raise ValueError(f'Unknown hypothesis: {h_type}')
+
+        # hypotheses are only dependent if they share a track, so split the
+        # problem into independent subproblems (connected components of A)
+        n_subproblems, labels = connected_components(bmat([[None, A],
+                                                           [A.T, None]]),
+                                                     directed=False)
+        trk_labels, h_labels = labels[:2*N], labels[2*N:]
+
+        # a track without any hypotheses can not satisfy the constraints
+        if np.setdiff1d(trk_labels, h_labels).size:
+            logger.warning('Optimizer returned status: infeasible')
+            return []
+
+        # group the hypotheses and constraints by subproblem, and renumber the
+        # hypotheses within each subproblem
+        h_order = np.argsort(h_labels, kind='stable')
+        h_count = np.bincount(h_labels, minlength=n_subproblems)
+        h_start = np.cumsum(h_count) - h_count
+        h_local = np.empty((n_hypotheses,), dtype=np.intp)
+        h_local[h_order] = np.arange(n_hypotheses) - h_start[h_labels[h_order]]
+
+        A = A.tocoo()
+        e_labels = h_labels[A.col]
+        e_order = np.argsort(e_labels, kind='stable')
+        e_count = np.bincount(e_labels, minlength=n_subproblems)
+        e_start = np.cumsum(e_count) - e_count
+
+        # the log likelihoods are stored in single precision, which is far
+        # below the uncertainty of the estimates used to calculate them
+        rho = fields['probability'].astype(np.float32)
+
+        logger.info(f'Optimizing {n_subproblems} subproblems...')
+
+        results = []
+        for i in range(n_subproblems):
+            h_idx = h_order[h_start[i]:h_start[i]+h_count[i]]
+            e_idx = e_order[e_start[i]:e_start[i]+e_count[i]]
+            x = self._solve(A.row[e_idx], h_local[A.col[e_idx]], rho[h_idx], N)
+            if x is None:
+                return []
+            results.append(h_idx[x])
+
+        # return only the selected hypotheses
+        results = np.sort(np.concatenate(results)).tolist()
+
+        logger.info('Optimization complete. (Solution: optimal)')
+        return results
+
+    def _solve(self, rows, cols, log_likelihood, N):
+        """ Solve an independent subproblem, with the constraints given by the
+        (row, col) entries of A. Returns the (local) indices of the selected
+        hypotheses, or None if the optimisation failed. """
+
+        n_hypotheses = log_likelihood.shape[0]
+
+        # renumber the constraints of this subproblem, rows in the first half
+        # of A are track ends, rows in the second half are track starts
+        trks, rows = np.unique(rows, return_inverse=True)
+        is_end = trks < N
+
+        # very small subproblems are faster to search than to set up a solver
+        if n_hypotheses < MAX_SEARCH_HYPOTHESES:
+            x = self._optimise_search(rows, cols, trks.shape[0], log_likelihood)
+            if x is not None:
+                return x
+
+        # if each hypothesis only ends and/or starts a single track, this is a
+        # linear assignment problem which can be solved in polynomial time
+        n_entries = np.bincount(cols, minlength=n_hypotheses)
+        n_ends = np.bincount(cols, weights=is_end[rows], minlength=n_hypotheses)
+        if np.all((n_entries == 1) | ((n_entries == 2) & (n_ends == 1))):
+            try:
+                return self._optimise_assignment(rows, cols, is_end,
+                                                 log_likelihood)
+            except ValueError:
+                logger.warning('No full assignment found, using GLPK...')
+
+        return self._optimise_ilp(rows, cols, trks.shape[0], log_likelihood)
+
+    def _optimise_ilp(self, rows, cols, n_rows, log_likelihood):
+        """ Solve the subproblem as an integer linear program using GLPK. """
+
+        n_hypotheses = log_likelihood.shape[0]
+
+        A = spmatrix(1., rows, cols, (n_rows, n_hypotheses), 'd')
+        rho = matrix(log_likelihood.astype(np.float64), (n_hypotheses, 1), 'd')
 
         # now set up the ILP solver
-        G = spmatrix([], [], [], (2*N, n_hypotheses), 'd')
-        h = matrix(0., (2*N,1), 'd')      # NOTE h cannot be a sparse matrix
+        G = spmatrix([], [], [], (n_rows, n_hypotheses), 'd')
+        h = matrix(0., (n_rows,1), 'd')   # NOTE h cannot be a sparse matrix
         I = set()                         # empty set of x which are integer
         B = set(range(n_hypotheses))      # signifies all are binary in x
-        b = matrix(1., (2*N,1), 'd')
+        b = matrix(1., (n_rows,1), 'd')
+
+        # since there may be many subproblems, silence GLPK unless requested
+        options = {'msg_lev': 'GLP_MSG_OFF', **self.options}
 
         # now try to solve it!!!
-        status, x = ilp(-rho, -G, h, A, b, I, B, options=self.options)
+        status, x = ilp(-rho, -G, h, A, b, I, B, options=options)
 
         # log the warning if not optimal solution
         if status != 'optimal':
             logger.warning(f'Optimizer returned status: {status}')
-            return []
+            return None
+
+        return np.flatnonzero(np.array(x).ravel() > 0)
+
+    def _optimise_search(self, rows, cols, n_rows, log_likelihood):
+        """ Solve a small subproblem by a depth first search of the sets of
+        hypotheses which satisfy every constraint exactly once. The constraints
+        are represented as bitmasks. Returns None if no solution exists. """
+
+        n_hypotheses = log_likelihood.shape[0]
+        ll = log_likelihood.tolist()
+
+        # bitmask of the constraints of each hypothesis, and the hypotheses
+        # which satisfy each constraint
+        h_mask = [0] * n_hypotheses
+        r_hyps = [[] for _ in range(n_rows)]
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            h_mask[c] |= 1 << r
+            r_hyps[r].append(c)
+
+        # log likelihoods are normally <= 0, so a partial solution can be
+        # discarded once it scores lower than the best complete solution
+        prune = max(ll) <= 0.
+        complete = (1 << n_rows) - 1
+        best_score, best = -np.inf, None
+
+        def search(satisfied, score, selected):
+            nonlocal best_score, best
+            if satisfied == complete:
+                if score > best_score:
+                    best_score, best = score, selected
+                return
+            if prune and score <= best_score:
+                return
+
+            # branch on the hypotheses of the first unsatisfied constraint
+            r = (~satisfied & (satisfied+1)).bit_length() - 1
+            for c in r_hyps[r]:
+                if not h_mask[c] & satisfied:
+                    search(satisfied | h_mask[c], score+ll[c], selected+[c])
+
+        search(0, 0., [])
+
+        if best is None:
+            return None
+        return np.sort(np.array(best, dtype=np.intp))
+
+    def _optimise_assignment(self, rows, cols, is_end, log_likelihood):
+        """
+        Solve the subproblem as a minimum weight bipartite matching. This is
+        only valid if there are no DIVIDE or MERGE hypotheses. We set up a
+        cost matrix in this manner: (n_ends + n_starts) x (n_starts + n_ends)
 
-        # return only the selected hypotheses
-        results = [i for i,h in enumerate(self.hypotheses) if x[i]>0]
+            [ link  term ]
+            [ init  aux  ]
 
-        logger.info(f'Optimization complete. (Solution: {status})')
-        return results
+        where the rows are the track ends, the columns are the track starts
+        and a false positive is a link of a track to itself. The auxiliary
+        block is the transpose of the link block, with zero cost. Since every
+        complete matching has the same number of entries, the costs can be
+        offset to make them strictly positive without changing the solution.
+
+        Raises:
+            ValueError if no complete matching exists
+        """
 
+        n_hypotheses = log_likelihood.shape[0]
+        n_ends = np.count_nonzero(is_end)
+        n_starts = is_end.shape[0] - n_ends
+        sz = n_ends + n_starts
+
+        # index of the track end and track start of each hypothesis
+        trk = np.empty(is_end.shape, dtype=np.intp)
+        trk[is_end] = np.arange(n_ends)
+        trk[~is_end] = np.arange(n_starts)
+        end = np.full((n_hypotheses,), -1, dtype=np.intp)
+        start = np.full((n_hypotheses,), -1, dtype=np.intp)
+        end[cols[is_end[rows]]] = trk[rows[is_end[rows]]]
+        start[cols[~is_end[rows]]] = trk[rows[~is_end[rows]]]
+
+        link = (end >= 0) & (start >= 0)
+        term = start < 0
+        init = end < 0
+
+        h_idx = np.arange(n_hypotheses)
+        C_rows = np.concatenate([end[link], end[term],
+                                 n_ends+start[init], n_ends+start[link]])
+        C_cols = np.concatenate([start[link], n_starts+end[term],
+                                 start[init], n_starts+end[link]])
+        hyps = np.concatenate([h_idx[link], h_idx[term], h_idx[init],
+                               np.full((np.count_nonzero(link),), -1)])
+        cost = np.where(hyps >= 0, -log_likelihood[hyps].astype(np.float64), 0.)
+
+        # where there are several hypotheses for the same entry, (e.g.
+        # different types of termination) only keep the most likely
+        key = C_rows * sz + C_cols
+        order = np.lexsort((cost, key))
+        key, first = np.unique(key[order], return_index=True)
+        keep = order[first]
+
+        weights = cost[keep] - cost[keep].min() + 1.
+        C = coo_matrix((weights, (C_rows[keep], C_cols[keep])), shape=(sz, sz))
+        row, col = min_weight_full_bipartite_matching(C.tocsr())
+
+        selected = hyps[keep][np.searchsorted(key, row * sz + col)]
+        return np.sort(selected[selected >= 0])
 
 if __name__ == '__main__':
     pass
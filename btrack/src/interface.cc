@@ -120,6 +120,15 @@ EXTERN_DECL {
     h->append( new_object );
   }
 
+  SHARED_LIB void append_array( InterfaceWrapper* h,
+                                const PyTrackObject* new_objects,
+                                const unsigned int n_objects ) {
+    /* append_array
+    Take an array of TrackObjects and append them to the tracker.
+    */
+    h->append_array( new_objects, n_objects );
+  }
+
 
   /* =========================================================================
   RUN THE TRACKING CODE
@@ -253,6 +262,13 @@ EXTERN_DECL {
     return h->get_hypothesis(a_ID);
   };
 
+  SHARED_LIB void get_all_hypotheses(InterfaceWrapper* h,
+                                     PyHypothesis* output,
+                                     const unsigned int n_hypotheses)
+  {
+    h->get_all_hypotheses(output, n_hypotheses);
+  };
+
   SHARED_LIB void merge(InterfaceWrapper*h,
                         unsigned int* a_hypotheses,
                         unsigned int n_hypotheses)
@@ -82,6 +82,15 @@ void InterfaceWrapper::append(const PyTrackObject a_object)
   tracker.append( a_object );
 };
 
+// append an array of new objects to the tracker
+void InterfaceWrapper::append_array( const PyTrackObject* a_objects,
+                                     const unsigned int n )
+{
+  for (size_t i=0; i<n; i++) {
+    tracker.append( a_objects[i] );
+  }
+};
+
 // run the complete tracking
 const PyTrackInfo* InterfaceWrapper::track()
 {
@@ -295,6 +304,15 @@ PyHypothesis InterfaceWrapper::get_hypothesis(const unsigned int a_ID)
   return h_engine.get_hypothesis(a_ID);
 };
 
+// get all of the hypotheses, output must have space for n hypotheses
+void InterfaceWrapper::get_all_hypotheses( PyHypothesis* output,
+                                           const unsigned int n )
+{
+  for (size_t i=0; i<n; i++) {
+    output[i] = h_engine.get_hypothesis(i);
+  }
+};
+
 
 // merge tracks based on hypothesis IDs
 void InterfaceWrapper::merge( unsigned int* a_hypotheses,